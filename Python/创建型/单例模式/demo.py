@@ -1,8 +1,22 @@
 #!/usr/bin/env python3
 
+import asyncio
+import bisect
+import collections
+import contextlib
+import dbm
+import functools
+import pickle
+import sys
+import threading
 import time
 import random
 
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台退化为无跨进程锁
+    fcntl = None
+
 
 def do_something():
     """
@@ -13,21 +27,319 @@ def do_something():
     return s
 
 
-def get(refresh=False):
+async def do_something_async():
+    """
+    do_something 的协程版本, 等待期间不阻塞事件循环
+    """
+    s = random.randint(1, 5)
+    await asyncio.sleep(s)
+    return s
+
+
+_MISSING = object()
+
+
+class Resource:
+    """
+    线程安全的单次加载(single-flight)缓存
+
+    同一时刻只有一个调用者执行 loader, 其余调用者等待并共享它的结果。
+    ttl 为 None 表示永不过期; stale_while_revalidate 为真时, 过期的值
+    会继续返回给调用者, 同时在后台线程中刷新。
+    """
+
+    def __init__(self, loader, ttl=None, stale_while_revalidate=False):
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self._condition = threading.Condition(threading.Lock())
+        self._value = _MISSING
+        self._expires = None
+        self._loading = False
+        # 每完成一次加载加一, 等待者据此判断自己等的那次加载是否已结束
+        self._generation = 0
+        self._error = None
+
+    def _fresh(self, now):
+        return self._value is not _MISSING and (
+            self._expires is None or now < self._expires
+        )
+
+    def get(self, refresh=False):
+        with self._condition:
+            now = time.monotonic()
+            if not refresh and self._fresh(now):
+                return self._value
+            if self._value is not _MISSING and self.stale_while_revalidate:
+                # 旧值照常返回, 刷新交给后台线程
+                if not self._loading:
+                    self._loading = True
+                    threading.Thread(target=self._load, daemon=True).start()
+                return self._value
+            if self._loading:
+                return self._wait()
+            self._loading = True
+        value, error = self._load()
+        if error is not None:
+            raise error
+        return value
+
+    def invalidate(self):
+        with self._condition:
+            self._value = _MISSING
+            self._expires = None
+
+    def _wait(self):
+        # 调用时已持有锁
+        generation = self._generation
+        while self._generation == generation:
+            self._condition.wait()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _load(self):
+        value = error = None
+        try:
+            value = self.loader()
+        except Exception as err:
+            error = err
+        except BaseException as err:
+            # KeyboardInterrupt 等: 唤醒等待者(它们得到同一个异常)后继续向上抛出
+            error = err
+            raise
+        finally:
+            with self._condition:
+                if error is None:
+                    self._value = value
+                    self._expires = (
+                        None if self.ttl is None else time.monotonic() + self.ttl
+                    )
+                self._error = error
+                self._loading = False
+                self._generation += 1
+                self._condition.notify_all()
+        return value, error
+
+
+class AsyncResource:
+    """
+    Resource 的 asyncio 版本
+
+    并发的等待者共享同一个加载任务; 每个等待者通过 asyncio.shield
+    等待该任务, 因此取消其中一个等待者不会取消共享的加载。
+    """
+
+    def __init__(self, loader, ttl=None):
+        self.loader = loader
+        self.ttl = ttl
+        self._value = _MISSING
+        self._expires = None
+        self._task = None
+
+    async def get(self, refresh=False):
+        if not refresh and self._value is not _MISSING:
+            if self._expires is None or time.monotonic() < self._expires:
+                return self._value
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._load())
+        return await asyncio.shield(self._task)
+
+    def invalidate(self):
+        self._value = _MISSING
+        self._expires = None
+
+    async def _load(self):
+        try:
+            value = await self.loader()
+            self._value = value
+            self._expires = None if self.ttl is None else time.monotonic() + self.ttl
+            return value
+        finally:
+            self._task = None
 
-    if refresh:
-        get.resource = ""
 
-    if get.resource:
-        return get.resource
+class Registry:
+    """
+    按 key 懒加载的资源注册表
+
+    每个 key 对应一个 Resource, 因此同一个 key 的并发加载也只执行一次。
+    超过 max_entries 个条目或 max_bytes 字节(由 sizeof 估算)时,
+    按最近最少使用(LRU)的顺序淘汰; 同时统计命中、未命中、淘汰次数
+    和加载耗时的直方图。
+    """
+
+    # 加载耗时直方图的桶上界(秒)
+    LOAD_BUCKETS = (0.001, 0.01, 0.1, 1, 10, float("inf"))
+
+    def __init__(
+        self, loader, max_entries=None, max_bytes=None, sizeof=sys.getsizeof, ttl=None
+    ):
+        self.loader = loader
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_histogram = [0] * len(Registry.LOAD_BUCKETS)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, refresh=False):
+        with self._lock:
+            resource = self._entries.get(key)
+            if resource is None:
+                resource = Resource(functools.partial(self._load, key), self.ttl)
+                self._entries[key] = resource
+            else:
+                self._entries.move_to_end(key)
+            if not refresh and resource._fresh(time.monotonic()):
+                self.hits += 1
+            else:
+                self.misses += 1
+        return resource.get(refresh)
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._bytes -= self._sizes.pop(key, 0)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                entries=len(self._entries),
+                bytes=self._bytes,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                load_histogram=dict(zip(Registry.LOAD_BUCKETS, self.load_histogram)),
+            )
+
+    def _load(self, key):
+        start = time.perf_counter()
+        value = self.loader(key)
+        elapsed = time.perf_counter() - start
+        size = self.sizeof(value)
+        with self._lock:
+            self.load_histogram[bisect.bisect_left(Registry.LOAD_BUCKETS, elapsed)] += 1
+            # 加载期间条目可能已被淘汰, 此时不再计入容量
+            if key in self._entries:
+                self._bytes += size - self._sizes.get(key, 0)
+                self._sizes[key] = size
+                self._evict(key)
+        return value
+
+    def _evict(self, keep):
+        # 调用时已持有锁; 刚加载的 keep 不参与淘汰
+        while (
+            self.max_entries is not None and len(self._entries) > self.max_entries
+        ) or (self.max_bytes is not None and self._bytes > self.max_bytes):
+            key = next(iter(self._entries))
+            if key == keep:
+                if len(self._entries) == 1:
+                    break
+                self._entries.move_to_end(key)
+                continue
+            del self._entries[key]
+            self._bytes -= self._sizes.pop(key, 0)
+            self.evictions += 1
+
+
+class DiskStore:
+    """
+    基于 dbm 的跨进程持久化缓存, 让新进程启动时就是"热"的
+
+    记录中带有 version, 版本不一致或超过 max_age 秒的记录视为失效。
+    写入在一个文件锁(fcntl.flock)内完成, 并在持锁后再检查一次,
+    因此多个进程同时冷启动时只有一个进程真正执行 loader。
+    """
+
+    def __init__(self, path, version=1, max_age=None):
+        self.path = path
+        self.version = version
+        self.max_age = max_age
+
+    def loader(self, loader, key="resource"):
+        # 包装成可以直接交给 Resource 的无参加载函数
+        return functools.partial(self.load, loader, key)
+
+    def load(self, loader, key="resource"):
+        with self._locked(fcntl.LOCK_SH if fcntl else None):
+            found, value = self._read(key)
+        if found:
+            return value
+        with self._locked(fcntl.LOCK_EX if fcntl else None):
+            found, value = self._read(key)
+            if not found:
+                value = loader()
+                record = pickle.dumps((self.version, time.time(), value))
+                with dbm.open(self.path, "c") as db:
+                    db[key] = record
+        return value
+
+    def invalidate(self, key=None):
+        with self._locked(fcntl.LOCK_EX if fcntl else None):
+            with dbm.open(self.path, "c") as db:
+                if key is None:
+                    for name in list(db.keys()):
+                        del db[name]
+                elif key in db:
+                    del db[key]
 
-    get.resource = do_something()
+    def _read(self, key):
+        try:
+            with dbm.open(self.path, "r") as db:
+                record = db.get(key)
+        except dbm.error:
+            return False, None
+        if record is None:
+            return False, None
+        version, created, value = pickle.loads(record)
+        if version != self.version:
+            return False, None
+        if self.max_age is not None and time.time() - created > self.max_age:
+            return False, None
+        return True, value
 
-    return get.resource
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        if operation is None:
+            yield
+            return
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def get(refresh=False):
+    # refresh 不再清空旧值, 而是与正在进行的加载合并
+    return get.resource.get(refresh)
 
 
 # 把全局状态放到私有变量中
-get.resource = {}
+get.resource = Resource(do_something)
+# 需要跨进程预热时, 改为:
+# get.resource = Resource(DiskStore("resource.db").loader(do_something))
+
+
+async def aget(refresh=False):
+    return await aget.resource.get(refresh)
+
+
+aget.resource = AsyncResource(do_something_async)
 
 
 def main():
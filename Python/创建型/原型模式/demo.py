@@ -1,12 +1,46 @@
 #!/bin/bash/env python3
 import sys
+import collections.abc
 import copy
+import functools
+import importlib
+import inspect
+import itertools
+import operator
+import timeit
+from array import array
+
+try:
+    import numpy
+except ImportError:  # 没有 NumPy 时退化为标准库 array('d')
+    numpy = None
 
 
 def make_object(cls, *args, **kwargs):
     return cls(*args, **kwargs)
 
 
+@functools.lru_cache(maxsize=None)
+def resolve(name):
+    # 类名只解析一次; "package.module.Class" 形式从对应模块中查找
+    module, _, attr = name.rpartition(".")
+    if module:
+        return getattr(importlib.import_module(module), attr)
+    return getattr(sys.modules[__name__], attr)
+
+
+def make_objects(cls, rows, lazy=False):
+    """
+    批量创建对象: cls 可以是类或类名, rows 是参数元组的可迭代对象
+
+    lazy 为真时返回生成器, 否则返回列表
+    """
+    if isinstance(cls, str):
+        cls = resolve(cls)
+    objects = itertools.starmap(cls, rows)
+    return objects if lazy else list(objects)
+
+
 class Point(object):
     __slots__ = ("x", "y")
 
@@ -18,6 +52,251 @@ class Point(object):
         return "Point({},{})".format(self.x, self.y)
 
 
+class PointView:
+    """
+    PointArray 中某一行的轻量视图, 读写直接落在列数组上, 不复制数据
+    """
+
+    __slots__ = ("_points", "_index")
+
+    def __init__(self, points, index):
+        self._points = points
+        self._index = index
+
+    @property
+    def x(self):
+        return self._points.x[self._index]
+
+    @x.setter
+    def x(self, value):
+        self._points.x[self._index] = value
+
+    @property
+    def y(self):
+        return self._points.y[self._index]
+
+    @y.setter
+    def y(self, value):
+        self._points.y[self._index] = value
+
+    def __repr__(self):
+        return "Point({},{})".format(self.x, self.y)
+
+
+class PointArray:
+    """
+    列式(struct-of-arrays)存储的大量点: x 和 y 各占一个连续的 double 数组
+
+    有 NumPy 时使用 numpy.ndarray, 否则使用 array('d');
+    每个点只占 16 字节, 没有逐对象的开销。
+    """
+
+    def __init__(self, xs=(), ys=()):
+        self.x = PointArray._column(xs)
+        self.y = PointArray._column(ys)
+        if len(self.x) != len(self.y):
+            raise ValueError("x and y must have the same length")
+
+    @staticmethod
+    def _column(values):
+        if numpy is not None:
+            if isinstance(values, collections.abc.Sequence) or hasattr(
+                values, "__array__"
+            ):
+                return numpy.array(values, dtype=float)
+            # 生成器等一般的可迭代对象
+            return numpy.fromiter(values, dtype=float)
+        return array("d", values)
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        flat = itertools.chain.from_iterable(pairs)
+        if numpy is not None:
+            flat = numpy.fromiter(flat, dtype=float)
+        else:
+            flat = array("d", flat)
+        return cls(flat[0::2], flat[1::2])
+
+    @classmethod
+    def from_points(cls, points):
+        return cls.from_pairs((point.x, point.y) for point in points)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        try:
+            # 也接受 numpy.int64 等整数标量, 例如 argmax 的返回值
+            index = operator.index(index)
+        except TypeError:
+            raise TypeError("PointArray indices must be integers") from None
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("PointArray index out of range")
+        return PointView(self, index)
+
+    def __iter__(self):
+        return (PointView(self, index) for index in range(len(self)))
+
+    def translate(self, dx, dy):
+        if numpy is not None:
+            self.x += dx
+            self.y += dy
+        else:
+            self.x[:] = array("d", map(float(dx).__add__, self.x))
+            self.y[:] = array("d", map(float(dy).__add__, self.y))
+        return self
+
+    def scale(self, sx, sy=None):
+        sy = sx if sy is None else sy
+        if numpy is not None:
+            self.x *= sx
+            self.y *= sy
+        else:
+            self.x[:] = array("d", map(float(sx).__mul__, self.x))
+            self.y[:] = array("d", map(float(sy).__mul__, self.y))
+        return self
+
+
+def _slots(cls):
+    # 收集类及其父类上声明的全部 __slots__ 及其描述符的 __set__;
+    # "__name" 形式的私有槽位按名称改写规则换成 "_Class__name"
+    names = []
+    for klass in reversed(cls.__mro__):
+        slots = klass.__dict__.get("__slots__", ())
+        for name in (slots,) if isinstance(slots, str) else slots:
+            if name in ("__dict__", "__weakref__"):
+                continue
+            if name.startswith("__") and not name.endswith("__"):
+                name = "_{}{}".format(klass.__name__.lstrip("_"), name)
+            names.append((name, klass.__dict__[name].__set__))
+    return tuple(names)
+
+
+def _takes_fields(cls, fields):
+    # 构造函数的参数正好是这些字段(同样的顺序)时, 认为可以用它来克隆
+    try:
+        parameters = inspect.signature(cls).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    return [(p.name, p.kind) for p in parameters] == [
+        (field, inspect.Parameter.POSITIONAL_OR_KEYWORD) for field in fields
+    ]
+
+
+_IMMUTABLE = (type(None), bool, int, float, complex, str, bytes, range)
+
+
+def _immutable(value):
+    if isinstance(value, (tuple, frozenset)):
+        return all(map(_immutable, value))
+    return isinstance(value, _IMMUTABLE)
+
+
+class PrototypeRegistry:
+    """
+    原型注册表: 先用名字注册原型, 再用 clone(name, **overrides) 复制
+
+    注册时深拷贝出原型的字段(__slots__ 中的槽位, 没有 __slots__ 时是
+    __dict__), 之后再修改原型不会影响克隆。构造函数的参数正好是这些
+    字段时, clone 是一次预先绑定好参数的构造调用(functools.partial),
+    否则绕过 __init__ 逐个写入字段。字段值都是不可变对象时克隆之间
+    共享这些值, 否则每次克隆都深拷贝一份, 与 copy.deepcopy 的语义一致。
+    """
+
+    def __init__(self):
+        self._prototypes = {}
+        self._factories = {}
+
+    def register(self, name, prototype):
+        cls = type(prototype)
+        slots = _slots(cls)
+        if slots:
+            fields = tuple(slot for slot, _ in slots)
+        elif hasattr(prototype, "__dict__"):
+            fields = tuple(vars(prototype))
+        else:
+            raise TypeError(
+                "cannot register {} as a prototype: it has neither __slots__ "
+                "nor __dict__".format(cls.__name__)
+            )
+        values = copy.deepcopy(tuple(getattr(prototype, field) for field in fields))
+        kwargs = dict(zip(fields, values))
+        setters = None
+        if not _takes_fields(cls, fields):
+            setters = tuple(setter for _, setter in slots)
+        shared = all(map(_immutable, values))
+        if shared and setters is None:
+            factory = functools.partial(cls, *values)
+        else:
+            factory = functools.partial(
+                PrototypeRegistry._build, cls, kwargs, setters, shared, {}
+            )
+        self._prototypes[name] = (cls, kwargs, setters, shared)
+        self._factories[name] = factory
+
+    def unregister(self, name):
+        del self._prototypes[name]
+        del self._factories[name]
+
+    def clone(self, name, **overrides):
+        if not overrides:
+            return self._factories[name]()
+        cls, kwargs, setters, shared = self._prototypes[name]
+        if not overrides.keys() <= kwargs.keys():
+            raise TypeError(
+                "{} has no attribute(s) {}".format(
+                    cls.__name__, ", ".join(overrides.keys() - kwargs.keys())
+                )
+            )
+        return PrototypeRegistry._build(cls, kwargs, setters, shared, overrides)
+
+    @staticmethod
+    def _build(cls, kwargs, setters, shared, overrides):
+        if not shared:
+            kwargs = copy.deepcopy(kwargs)
+        if overrides:
+            kwargs = {**kwargs, **overrides}
+        if setters is None:
+            return cls(**kwargs)
+        # 构造函数不可用, 绕过 __init__ 直接写入槽位或 __dict__
+        obj = cls.__new__(cls)
+        if setters:
+            for set_slot, value in zip(setters, kwargs.values()):
+                set_slot(obj, value)
+        else:
+            obj.__dict__.update(kwargs)
+        return obj
+
+
+prototypes = PrototypeRegistry()
+prototypes.register("origin", Point(0, 0))
+
+
+# 直接绑定到默认注册表, 省去一层函数调用
+clone = prototypes.clone
+
+
+def benchmark(number=100000):
+    p = Point(5, 10)
+    module = sys.modules[__name__]
+    routes = (
+        ("Point(x, y)", lambda: Point(1, 2)),
+        ("eval", lambda: eval("{}({}, {})".format("Point", 2, 4))),
+        ("getattr(sys.modules)", lambda: getattr(module, "Point")(3, 6)),
+        ("globals()", lambda: globals()["Point"](4, 8)),
+        ("make_object", lambda: make_object(Point, 5, 10)),
+        ("copy.deepcopy", lambda: copy.deepcopy(p)),
+        ("__class__", lambda: p.__class__(7, 14)),
+        ("clone", lambda: clone("origin")),
+        ("clone(**overrides)", lambda: clone("origin", x=8, y=16)),
+    )
+    for name, route in routes:
+        seconds = min(timeit.repeat(route, number=number, repeat=3))
+        print("{:<22}{:>10.3f} us".format(name, seconds / number * 1e6))
+
+
 def main():
     # 创建Point对象的7个方式
 
@@ -31,6 +310,16 @@ def main():
     # python 原型模式
     p7 = p1.__class__(7, 14)
     print(p1, p2, p3, p4, p5, p6, p7)
+    # 批量创建
+    print(make_objects("Point", ((i, i * 2) for i in range(3))))
+    # 原型注册表
+    print(clone("origin", x=8, y=16))
+    # 列式存储的大量点
+    points = PointArray.from_pairs((i, i * 2) for i in range(5))
+    points.translate(1, 1).scale(2)
+    print(points[0], points[-1])
+    if len(sys.argv) > 1 and sys.argv[1] == "-P":
+        benchmark()
 
 
 if __name__ == "__main__":
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
+# random, struct, mmap, timeit 等只在用到它们的函数中导入; 连 functools
+# 也不导入(它会带入 collections), 让只用棋盘的导入保持轻量
 import itertools
-import unicodedata
+import os
+import sys
 
 # 利用解包一次定义所有字符常量，方便编写调试和字符串驻留
 DRAUGHT, PAWN, ROOK, KNIGHT, BISHOP, KING, QUEEN = (
@@ -22,10 +25,210 @@ def console(char, background):
     )
 
 
-class AbstractBoard:
+class _SquareCache(dict):
+    # (piece, background) -> 渲染好的转义序列, 每种组合只格式化一次
+    def __missing__(self, key):
+        square = self[key] = console(*key)
+        return square
+
+
+SQUARES = _SquareCache()
+
+
+# 比 int.bit_count (Python 3.10+) 更早的版本退化为字符串计数
+_popcount = getattr(int, "bit_count", None) or (lambda bits: bin(bits).count("1"))
+
+KNIGHT_STEPS = ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2))
+ROOK_STEPS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+BISHOP_STEPS = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+KING_STEPS = ROOK_STEPS + BISHOP_STEPS
+
+
+def _memoize(function):
+    # 按位置参数缓存结果的简单版 functools.lru_cache(maxsize=None)
+    cache = {}
+
+    def wrapper(*args):
+        try:
+            return cache[args]
+        except KeyError:
+            result = cache[args] = function(*args)
+            return result
+
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+
+@_memoize
+def _step_masks(rows, columns, steps):
+    # 每个格子走一步可到达的格子集合, 按棋盘尺寸预先算好
+    masks = []
+    for row in range(rows):
+        for column in range(columns):
+            mask = 0
+            for dy, dx in steps:
+                y, x = row + dy, column + dx
+                if 0 <= y < rows and 0 <= x < columns:
+                    mask |= 1 << (y * columns + x)
+            masks.append(mask)
+    return masks
+
+
+@_memoize
+def _rays(rows, columns, steps):
+    # 每个格子沿各方向的射线, 每条射线是由近及远的格子位列表
+    rays = []
+    for row in range(rows):
+        for column in range(columns):
+            square = []
+            for dy, dx in steps:
+                ray = []
+                y, x = row + dy, column + dx
+                while 0 <= y < rows and 0 <= x < columns:
+                    ray.append(1 << (y * columns + x))
+                    y, x = y + dy, x + dx
+                square.append(ray)
+            rays.append(square)
+    return rays
+
+
+class Bitboard:
+    """
+    位棋盘: 每种 (kind, color) 用一个整数表示, 第 row * columns + column
+    位为 1 表示该格有这种棋子
+
+    支持 board[row][column] 的读写, 因此可以直接替换列表形式的棋盘。
+    """
+
     def __init__(self, rows, columns):
-        # 生成空棋盘二维数组
-        self.board = [[None for _ in range(columns)] for _ in range(rows)]
+        self.rows = rows
+        self.columns = columns
+        self.pieces = {}
+        self.occupied = 0
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, row):
+        # 与列表一样支持负数下标
+        if row < 0:
+            row += self.rows
+        if not 0 <= row < self.rows:
+            raise IndexError("row out of range")
+        return _BitboardRow(self, row)
+
+    def __iter__(self):
+        return (_BitboardRow(self, row) for row in range(self.rows))
+
+    def get(self, row, column):
+        bit = 1 << (row * self.columns + column)
+        if self.occupied & bit:
+            for (kind, color), bits in self.pieces.items():
+                if bits & bit:
+                    return create_piece(kind, color)
+        return None
+
+    def set(self, row, column, piece):
+        bit = 1 << (row * self.columns + column)
+        if self.occupied & bit:
+            for key, bits in self.pieces.items():
+                if bits & bit:
+                    self.pieces[key] = bits & ~bit
+                    break
+            self.occupied &= ~bit
+        if piece is not None:
+            key = _PIECE_KEYS[piece]
+            self.pieces[key] = self.pieces.get(key, 0) | bit
+            self.occupied |= bit
+
+    def occupancy(self, color=None):
+        if color is None:
+            return self.occupied
+        occupied = 0
+        for (_, piece_color), bits in self.pieces.items():
+            if piece_color == color:
+                occupied |= bits
+        return occupied
+
+    def count(self, kind=None, color=None):
+        if kind is None and color is None:
+            return _popcount(self.occupied)
+        return sum(
+            _popcount(bits)
+            for (piece_kind, piece_color), bits in self.pieces.items()
+            if kind in (None, piece_kind) and color in (None, piece_color)
+        )
+
+    def attacks(self, row, column):
+        """
+        返回该格棋子攻击到的格子位掩码, 空格返回 0
+        """
+        piece = self.get(row, column)
+        if piece is None:
+            return 0
+        kind, color = _PIECE_KEYS[piece]
+        square = row * self.columns + column
+        if kind == KNIGHT:
+            return _step_masks(self.rows, self.columns, KNIGHT_STEPS)[square]
+        if kind == KING:
+            return _step_masks(self.rows, self.columns, KING_STEPS)[square]
+        if kind in (PAWN, DRAUGHT):
+            # 黑方在上方 (row 0) 向下走, 白方向上走
+            forward = 1 if color == BLACK else -1
+            steps = ((forward, -1), (forward, 1))
+            return _step_masks(self.rows, self.columns, steps)[square]
+        steps = {ROOK: ROOK_STEPS, BISHOP: BISHOP_STEPS, QUEEN: KING_STEPS}[kind]
+        mask = 0
+        for ray in _rays(self.rows, self.columns, steps)[square]:
+            for bit in ray:
+                mask |= bit
+                if self.occupied & bit:
+                    break
+        return mask
+
+
+class _BitboardRow:
+
+    __slots__ = ("_bitboard", "_row")
+
+    def __init__(self, bitboard, row):
+        self._bitboard = bitboard
+        self._row = row
+
+    def __len__(self):
+        return self._bitboard.columns
+
+    def _column(self, column):
+        # 与列表一样支持负数下标
+        if column < 0:
+            column += self._bitboard.columns
+        if not 0 <= column < self._bitboard.columns:
+            raise IndexError("column out of range")
+        return column
+
+    def __getitem__(self, column):
+        column = self._column(column)
+        return self._bitboard.get(self._row, column)
+
+    def __setitem__(self, column, piece):
+        column = self._column(column)
+        self._bitboard.set(self._row, column, piece)
+
+    def __iter__(self):
+        return (
+            self._bitboard.get(self._row, column)
+            for column in range(self._bitboard.columns)
+        )
+
+
+class AbstractBoard:
+    def __init__(self, rows, columns, bitboard=False):
+        if bitboard:
+            self.board = Bitboard(rows, columns)
+        else:
+            # 生成空棋盘二维数组
+            self.board = [[None for _ in range(columns)] for _ in range(rows)]
         self.populate_board()
 
     def populate_board(self):
@@ -35,14 +238,42 @@ class AbstractBoard:
         squares = []
         for y, row in enumerate(self.board):
             for x, piece in enumerate(row):
-                square = console(piece, BLACK if (y + x) % 2 else WHITE)
-                squares.append(square)
+                squares.append(SQUARES[piece, BLACK if (y + x) % 2 else WHITE])
             squares.append("\n")
         return "".join(squares)
 
 
-class CheckersBoard(AbstractBoard):
+class BoardRenderer:
+    """
+    增量渲染: 第一帧整屏绘制, 之后只用光标定位转义序列重绘变化的格子
+    """
+
     def __init__(self):
+        self._previous = None
+
+    def render(self, board):
+        rows = [list(row) for row in board.board]
+        previous, self._previous = self._previous, rows
+        if previous is None or len(previous) != len(rows):
+            return "\x1B[2J\x1B[H" + str(board)
+        squares = []
+        for y, (row, before) in enumerate(zip(rows, previous)):
+            for x, (piece, old) in enumerate(zip(row, before)):
+                if piece != old:
+                    squares.append(
+                        "\x1B[{};{}H".format(y + 1, x + 1)
+                        + SQUARES[piece, BLACK if (y + x) % 2 else WHITE]
+                    )
+        if squares:
+            # 把光标放回棋盘下方, 与整屏绘制后的位置一致
+            squares.append("\x1B[{};1H".format(len(rows) + 1))
+        return "".join(squares)
+
+
+class CheckersBoard(AbstractBoard):
+    def __init__(self, bitboard=False):
+        # 列表棋盘由 populate_board 整体生成, 不需要先建空棋盘
+        self.board = Bitboard(10, 10) if bitboard else None
         self.populate_board()
 
     def populate_board(self):
@@ -64,16 +295,21 @@ class CheckersBoard(AbstractBoard):
             (None, white()),
             (white(), None),
         )  # 4 white rows
-        print(list(rows))
-        self.board = [
+        squares = [
             list(itertools.islice(itertools.cycle(squares), 0, len(rows)))
             for squares in rows
         ]
+        if self.board is None:
+            self.board = squares
+        else:
+            for y, row in enumerate(squares):
+                for x, piece in enumerate(row):
+                    self.board[y][x] = piece
 
 
 class ChessBoard(AbstractBoard):
-    def __init__(self):
-        super().__init__(8, 8)
+    def __init__(self, bitboard=False):
+        super().__init__(8, 8, bitboard)
 
     def populate_board(self):
         rows = (
@@ -92,19 +328,20 @@ class ChessBoard(AbstractBoard):
                 self.board[row][column] = create_piece(PAWN, color)
 
 
+PIECE_NAMES = {
+    DRAUGHT: "Draught",
+    PAWN: "ChessPawn",
+    ROOK: "ChessRook",
+    KNIGHT: "ChessKnight",
+    BISHOP: "ChessBishop",
+    KING: "ChessKing",
+    QUEEN: "ChessQueen",
+}
+
+
 def create_piece(kind, color):
-    color = "White" if color == WHITE else "Black"
-    name = {
-        DRAUGHT: "Draught",
-        PAWN: "ChessPawn",
-        ROOK: "ChessRook",
-        KNIGHT: "ChessKnight",
-        BISHOP: "ChessBishop",
-        KING: "ChessKing",
-        QUEEN: "ChessQueen",
-    }[kind]
-    # 在全局命名空间中， 返回对应的类的对象
-    return globals()[color + name]()
+    # 棋子是不可变的 str 子类, 每个 (kind, color) 共享同一个享元实例
+    return _PIECES[kind, color]
 
 
 class Piece(str):
@@ -112,22 +349,308 @@ class Piece(str):
     __slots__ = ()
 
 
-for code in itertools.chain((0x26C0, 0x26C2), range(0x2654, 0x2660)):
-    # 获取旗子Unicode码位, 转换成字符
-    char = chr(code)
-    name = unicodedata.name(char).title().replace(" ", "")
-    # name与之前的命名统一
-    if name.endswith("sMan"):
-        name = name[:-4]
-    # type创建旗子类
-    new = (lambda char: lambda cls: Piece.__new__(cls, char))(char)
-    new.__name__ = "__new__"
-    cls = type(name, (Piece,), dict(__slots__=(), __new__=new))
-    # 在全局命名空间中， 创建对应的类
-    globals()[name] = cls
+# 棋子的 Unicode 码位, 类名(如 WhiteChessKing)由颜色和 PIECE_NAMES 拼出,
+# 与 unicodedata.name 得到的名字一致, 导入时不必再查 unicodedata
+PIECE_CODEPOINTS = {
+    (DRAUGHT, WHITE): 0x26C0,
+    (DRAUGHT, BLACK): 0x26C2,
+    (KING, WHITE): 0x2654,
+    (QUEEN, WHITE): 0x2655,
+    (ROOK, WHITE): 0x2656,
+    (BISHOP, WHITE): 0x2657,
+    (KNIGHT, WHITE): 0x2658,
+    (PAWN, WHITE): 0x2659,
+    (KING, BLACK): 0x265A,
+    (QUEEN, BLACK): 0x265B,
+    (ROOK, BLACK): 0x265C,
+    (BISHOP, BLACK): 0x265D,
+    (KNIGHT, BLACK): 0x265E,
+    (PAWN, BLACK): 0x265F,
+}
+_PIECE_CLASSES = {
+    ("White" if color == WHITE else "Black") + PIECE_NAMES[kind]: (kind, color)
+    for kind, color in PIECE_CODEPOINTS
+}
+_PIECE_KEYS = {chr(code): key for key, code in PIECE_CODEPOINTS.items()}
+
+
+def _piece_class(name):
+    # 第一次用到时才用 type 创建棋子类, 并放入全局命名空间
+    cls = globals().get(name)
+    if cls is None:
+        char = chr(PIECE_CODEPOINTS[_PIECE_CLASSES[name]])
+        new = (lambda char: lambda cls: Piece.__new__(cls, char))(char)
+        new.__name__ = "__new__"
+        cls = type(name, (Piece,), dict(__slots__=(), __new__=new))
+        globals()[name] = cls
+    return cls
+
+
+def __getattr__(name):
+    # 模块级 __getattr__: 从模块外访问 demo.WhiteChessKing 等时懒创建
+    if name in _PIECE_CLASSES:
+        return _piece_class(name)
+    if name == "RECORD":
+        return _record()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+class _PieceCache(dict):
+    # (kind, color) -> 共享的棋子实例, 第一次请求时创建
+    def __missing__(self, key):
+        kind, color = key
+        name = ("White" if color == WHITE else "Black") + PIECE_NAMES[kind]
+        piece = self[key] = _piece_class(name)()
+        return piece
+
+
+_PIECES = _PieceCache()
+
+if os.environ.get("BOARD_EAGER_PIECES"):
+    # 原来的做法: 导入时查 unicodedata 得到类名并创建全部棋子类,
+    # 只用于 import_benchmark 对比
+    import unicodedata
+
+    for code in PIECE_CODEPOINTS.values():
+        name = unicodedata.name(chr(code)).title().replace(" ", "")
+        if name.endswith("sMan"):
+            name = name[:-4]
+        _piece_class(name)
+
+# 紧凑的二进制局面格式: 1 字节棋盘类型 + 每格 4 位的棋子编码(0 为空格),
+# 最多 100 格, 所以每条记录固定 51 字节, 可以直接写入文件或 mmap 读取
+BOARD_TYPES = ("ChessBoard", "CheckersBoard")
+RECORD_SIZE = 51
+
+
+@_memoize
+def _record():
+    # struct.Struct("B50s"); 第一次编解码时才导入 struct, 模块外用 RECORD 访问
+    import struct
+
+    return struct.Struct("B50s")
+
+_PIECE_ORDER = [
+    (kind, color) for kind in PIECE_NAMES for color in (WHITE, BLACK)
+]
+_PIECE_CODES = {None: 0}
+_PIECE_CODES.update(
+    (chr(PIECE_CODEPOINTS[key]), code) for code, key in enumerate(_PIECE_ORDER, 1)
+)
+
+
+@_memoize
+def _code_pieces():
+    return [None] + [create_piece(kind, color) for kind, color in _PIECE_ORDER]
+
+
+def encode_board(board):
+    codes = [_PIECE_CODES[piece] for row in board.board for piece in row]
+    if len(codes) % 2:
+        codes.append(0)
+    packed = bytes(high << 4 | low for high, low in zip(codes[0::2], codes[1::2]))
+    return _record().pack(BOARD_TYPES.index(type(board).__name__), packed)
+
+
+def decode_board(record):
+    kind, packed = _record().unpack(record)
+    cls = globals()[BOARD_TYPES[kind]]
+    # 不调用 __init__, 以免重新摆放初始局面
+    board = cls.__new__(cls)
+    rows, columns = (8, 8) if cls is ChessBoard else (10, 10)
+    code_pieces = _code_pieces()
+    pieces = []
+    for byte in packed[: (rows * columns + 1) // 2]:
+        pieces.append(code_pieces[byte >> 4])
+        pieces.append(code_pieces[byte & 0xF])
+    board.board = [pieces[row * columns : (row + 1) * columns] for row in range(rows)]
+    return board
+
+
+def play(board, moves):
+    """
+    依次执行 ((from_row, from_column), (to_row, to_column)) 形式的着法,
+    不检查着法是否合法, 目标格上的棋子被吃掉
+    """
+    for (y0, x0), (y1, x1) in moves:
+        board.board[y1][x1] = board.board[y0][x0]
+        board.board[y0][x0] = None
+    return board
+
+
+def random_moves(board, seed, count=16):
+    # 由种子决定的随机着法序列, 用来批量生成不同的局面
+    import random
+
+    rng = random.Random(seed)
+    squares = [
+        (y, x) for y in range(len(board.board)) for x in range(len(board.board[0]))
+    ]
+    occupied = [(y, x) for y, x in squares if board.board[y][x] is not None]
+    moves = []
+    for _ in range(count):
+        index = rng.randrange(len(occupied))
+        source, target = occupied[index], rng.choice(squares)
+        if target == source:
+            continue
+        if target in occupied:
+            # 目标格上的棋子被吃掉
+            occupied.remove(target)
+            index = occupied.index(source)
+        occupied[index] = target
+        moves.append((source, target))
+    return moves
+
+
+def _generate_batch(board_type, specs):
+    cls = globals()[board_type]
+    records = []
+    for spec in specs:
+        board = cls()
+        moves = random_moves(board, spec) if isinstance(spec, int) else spec
+        records.append(encode_board(play(board, moves)))
+    return b"".join(records)
+
+
+def generate_boards(board_class, specs, processes=None, batch=1024, window=None):
+    """
+    在进程池中批量生成局面, spec 为随机种子(int)或着法序列
+
+    按输入顺序产出由若干条定长记录拼接成的 bytes; 同时最多有 window 批
+    (默认是进程数的两倍)在进行中, 内存占用与 specs 的总数无关
+    """
+    # 进程池只在用到时才导入, 不拖慢模块的导入
+    import collections
+    import concurrent.futures
+
+    board_type = board_class.__name__
+    if window is None:
+        window = 2 * (processes or os.cpu_count() or 1)
+    specs = iter(specs)
+    batches = iter(lambda: list(itertools.islice(specs, batch)), [])
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        for specs_batch in batches:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(executor.submit(_generate_batch, board_type, specs_batch))
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_boards(file, board_class, specs, processes=None):
+    count = 0
+    for records in generate_boards(board_class, specs, processes):
+        file.write(records)
+        count += len(records) // RECORD_SIZE
+    return count
+
+
+class PositionFile:
+    """
+    以 mmap 方式打开 write_boards 写出的文件, 只在访问某条记录时才解码
+    """
+
+    def __init__(self, filename):
+        import mmap
+
+        with open(filename, "rb") as file:
+            if os.fstat(file.fileno()).st_size:
+                self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # 空文件不能 mmap, 当作没有记录
+                self._mmap = b""
+
+    def __len__(self):
+        return len(self._mmap) // RECORD_SIZE
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("position index out of range")
+        start = index * RECORD_SIZE
+        return decode_board(self._mmap[start : start + RECORD_SIZE])
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def close(self):
+        # 空文件时是 bytes, 没有 close
+        close = getattr(self._mmap, "close", None)
+        if close is not None:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def benchmark(number=10000):
+    import timeit
+
+    boards = (
+        ("ChessBoard", ChessBoard),
+        ("CheckersBoard", CheckersBoard),
+        ("ChessBoard(bitboard)", lambda: ChessBoard(bitboard=True)),
+        ("CheckersBoard(bitboard)", lambda: CheckersBoard(bitboard=True)),
+    )
+    for name, factory in boards:
+        seconds = min(timeit.repeat(factory, number=number, repeat=3))
+        print("{:<24}{:>12,.0f} boards/s".format(name, number / seconds))
+    board = ChessBoard()
+    seconds = min(timeit.repeat(lambda: str(board), number=number, repeat=3))
+    print("{:<24}{:>12,.0f} renders/s".format("str(ChessBoard)", number / seconds))
+    seconds = min(
+        timeit.repeat(lambda: create_piece(PAWN, WHITE), number=number * 10, repeat=3)
+    )
+    print("{:<24}{:>12,.0f} pieces/s".format("create_piece", number * 10 / seconds))
+
+
+def import_benchmark(repeat=30):
+    """
+    在新的子进程中测量导入耗时, 取 repeat 次中最快的一次; eager 设置
+    BOARD_EAGER_PIECES, 在导入时查 unicodedata 并创建全部棋子类
+
+    先编译成 .pyc 再加载, 与正常导入命中字节码缓存时一致, 不计入编译时间
+    (例如设置了 PYTHONDONTWRITEBYTECODE 时)
+    """
+    import py_compile
+    import subprocess
+    import tempfile
+
+    code = (
+        "import importlib.machinery, importlib.util, time\n"
+        "start = time.perf_counter()\n"
+        "loader = importlib.machinery.SourcelessFileLoader('board', {path!r})\n"
+        "spec = importlib.util.spec_from_loader('board', loader)\n"
+        "module = importlib.util.module_from_spec(spec)\n"
+        "loader.exec_module(module)\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        path = py_compile.compile(
+            __file__, cfile=os.path.join(directory, "board.pyc"), doraise=True
+        )
+        command = [sys.executable, "-c", code.format(path=path)]
+        for name, eager in (("lazy", ""), ("eager", "1")):
+            env = dict(os.environ, BOARD_EAGER_PIECES=eager)
+            seconds = min(
+                float(subprocess.check_output(command, env=env))
+                for _ in range(repeat)
+            )
+            print("{:<24}{:>10.2f} ms".format(name, seconds * 1000))
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "-P":
+        benchmark()
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "-I":
+        import_benchmark()
+        return
     # board = ChessBoard()
     board = CheckersBoard()
     print(board)
@@ -1,9 +1,78 @@
 #!/usr/bin/env python3
 
 import abc
+import bisect
+import collections
+import functools
+import itertools
 import re
+import sys
 from html import escape
 
+# 跨 builder 共享的表单缓存: (builder 类型, 构建步骤序列) -> (表单, 字节数);
+# 按条目数和表单的总字节数(sys.getsizeof)淘汰, 步骤太多的表单不进共享缓存
+FORM_CACHE_SIZE = 256
+FORM_CACHE_BYTES = 16 << 20
+FORM_CACHE_MAX_STEPS = 4096
+_forms = collections.OrderedDict()
+_forms_bytes = 0
+
+
+def records_step(method):
+    """
+    记录一次 add_* 调用作为构建步骤, 并使已缓存的表单失效
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        # 调用成功后才记录, 抛出异常的调用不算一个步骤
+        result = method(self, *args, **kwargs)
+        self._steps.append((method.__name__, args, tuple(sorted(kwargs.items()))))
+        self._form = None
+        return result
+
+    return wrapper
+
+
+def memoized_form(method):
+    """
+    缓存 form() 的结果; 构建步骤相同的 builder 在进程内只渲染一次
+    """
+
+    @functools.wraps(method)
+    def wrapper(self):
+        if self._form is None:
+            if len(self._steps) > FORM_CACHE_MAX_STEPS:
+                # 很大的表单只缓存在当前 builder 上
+                self._form = method(self)
+                return self._form
+            key = (type(self), tuple(self._steps))
+            try:
+                form, _ = _forms[key]
+                _forms.move_to_end(key)
+            except KeyError:
+                form = method(self)
+                _cache_form(key, form)
+            except TypeError:
+                # 参数不可哈希, 只缓存在当前 builder 上
+                form = method(self)
+            self._form = form
+        return self._form
+
+    return wrapper
+
+
+def _cache_form(key, form):
+    global _forms_bytes
+    size = sys.getsizeof(form)
+    if size > FORM_CACHE_BYTES:
+        return
+    _forms[key] = (form, size)
+    _forms_bytes += size
+    while len(_forms) > FORM_CACHE_SIZE or _forms_bytes > FORM_CACHE_BYTES:
+        _, (_, evicted) = _forms.popitem(last=False)
+        _forms_bytes -= evicted
+
 
 class AbstractFormBuilder(metaclass=abc.ABCMeta):
     @abc.abstractmethod
@@ -31,48 +100,75 @@ class HtmlFormBuilder(AbstractFormBuilder):
     def __init__(self):
         self.title = "HtmlFormBuilder"
         self.items = {}
+        self._steps = []
+        self._form = None
+        # 按 (row, column) 有序的 key, 添加时维护, 输出时无需再排序
+        self._keys = []
 
+    @records_step
     def add_title(self, title):
         super().add_title(escape(title))
 
+    @records_step
     def add_label(self, text, row, column, **kwargs):
-        self.items[
-            (row, column)
-        ] = """<td><label for="{}">{}:</label></td>
+        html = """<td><label for="{}">{}:</label></td>
         """.format(
             kwargs["target"], escape(text)
         )
+        self._add_item(row, column, html)
 
+    @records_step
     def add_entry(self, variable, row, column, **kwargs):
         html = """<td><input name="{}" type="{}" /></td>""".format(
             variable, kwargs.get("kind", "text")
         )
-        self.items[(row, column)] = html
+        self._add_item(row, column, html)
 
+    @records_step
     def add_button(self, text, row, column, **kwargs):
         html = """<td><input type="submit" value="{}" /></td>
         """.format(
             escape(text)
         )
-        self.items[(row, column)] = html
+        self._add_item(row, column, html)
+
+    def _add_item(self, row, column, html):
+        key = (row, column)
+        if key not in self.items:
+            # 按顺序添加时 insort 只是追加到末尾
+            bisect.insort(self._keys, key)
+        self.items[key] = html
 
+    @memoized_form
     def form(self):
-        html = [
+        return "\n".join(self.iter_form())
+
+    def iter_form(self):
+        """
+        逐行生成表单, 与 form() 的结果按 "\n" 拼接后相同
+        """
+        yield (
             "<!doctype html>\n<html><head><title>{}</title></head>"
-            "<body>".format(self.title),
-            '<form><table border="0">',
-        ]
+            "<body>".format(self.title)
+        )
+        yield '<form><table border="0">'
         thisRow = None
-        for key, value in sorted(self.items.items()):
+        for key in self._keys:
             row, column = key
             if thisRow is None:
-                html.append("  <tr>")
+                yield "  <tr>"
             elif thisRow != row:
-                html.append("  </tr>\n  <tr>")
+                yield "  </tr>\n  <tr>"
             thisRow = row
-            html.append("    " + value)
-        html.append("  </tr>\n</table></form></body></html>")
-        return "\n".join(html)
+            yield "    " + self.items[key]
+        yield "  </tr>\n</table></form></body></html>"
+
+    def write_form(self, file):
+        # 流式写出, 内存占用与表单大小无关
+        for index, line in enumerate(self.iter_form()):
+            if index:
+                file.write("\n")
+            file.write(line)
 
 
 class TkFormBuilder(AbstractFormBuilder):
@@ -106,10 +202,14 @@ if __name__ == "__main__":
     def __init__(self):
         self.title = "TkFormBuilder"
         self.statements = []
+        self._steps = []
+        self._form = None
 
+    @records_step
     def add_title(self, title):
         super().add_title(title)
 
+    @records_step
     def add_label(self, text, row, column, **kwargs):
         name = self._canonicalize(text)
         create = """self.{}Label = ttk.Label(self, text="{}:")""".format(name, text)
@@ -119,6 +219,7 @@ padx="0.75m", pady="0.75m")""".format(
         )
         self.statements.extend((create, layout))
 
+    @records_step
     def add_entry(self, variable, row, column, **kwargs):
         name = self._canonicalize(variable)
         extra = "" if kwargs.get("kind") != "password" else ', show="*"'
@@ -129,6 +230,7 @@ tk.W, tk.E), padx="0.75m", pady="0.75m")""".format(
         )
         self.statements.extend((create, layout))
 
+    @records_step
     def add_button(self, text, row, column, **kwargs):
         name = self._canonicalize(text)
         create = """self.{}Button = ttk.Button(self, text="{}")
@@ -142,6 +244,7 @@ tk.W, tk.E), padx="0.75m", pady="0.75m")""".format(
         )
         self.statements.extend((create, layout))
 
+    @memoized_form
     def form(self):
         return TkFormBuilder.TEMPLATE.format(
             title=self.title,
@@ -156,6 +259,55 @@ tk.W, tk.E), padx="0.75m", pady="0.75m")""".format(
         return text if not startLower else text[0].lower() + text[1:]
 
 
+class FormSpec(AbstractFormBuilder):
+    """
+    只记录构建步骤的 builder, form() 返回步骤序列, 供 build_forms 重放
+    """
+
+    def __init__(self):
+        self._steps = []
+        self._form = None
+
+    @records_step
+    def add_title(self, title):
+        pass
+
+    @records_step
+    def add_label(self, text, row, column, **kwargs):
+        pass
+
+    @records_step
+    def add_entry(self, variable, row, column, **kwargs):
+        pass
+
+    @records_step
+    def add_button(self, text, row, column, **kwargs):
+        pass
+
+    def form(self):
+        return tuple(self._steps)
+
+
+def replay(builder, steps):
+    for name, args, kwargs in steps:
+        getattr(builder, name)(*args, **dict(kwargs))
+    return builder.form()
+
+
+def build_forms(create_form, builders, executor=None):
+    """
+    create_form 只执行一次, 记录下的步骤分发给所有 builder
+
+    传入线程池或进程池时各 builder 并行渲染; 按 builders 的顺序返回结果
+    """
+    spec = FormSpec()
+    create_form(spec)
+    steps = spec.form()
+    if executor is None:
+        return [replay(builder, steps) for builder in builders]
+    return list(executor.map(replay, builders, itertools.repeat(steps)))
+
+
 def main():
     def create_login_form(builder):
         builder.add_title("Login")
@@ -168,6 +320,7 @@ def main():
         return builder.form()
 
     # form = create_login_form(HtmlFormBuilder())
+    # html, form = build_forms(create_login_form, (HtmlFormBuilder(), TkFormBuilder()))
     form = create_login_form(TkFormBuilder())
     print(form)
 
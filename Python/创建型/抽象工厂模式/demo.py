@@ -1,10 +1,83 @@
 #!/usr/bin/env python3
 
+import collections
+import concurrent.futures
+import functools
+import gzip
+import itertools
+import mmap
+import timeit
+import tracemalloc
+from multiprocessing import shared_memory
+
+
+class SpatialIndex:
+    """
+    均匀网格空间索引: 每个条目登记到它覆盖的网格单元中,
+    query 按插入顺序(即 z-order)返回与窗口相交的条目编号
+
+    覆盖单元过多的大条目(如整个画布的外框)单独存放, 每次查询都检查
+    """
+
+    MAX_CELLS = 64
+
+    def __init__(self, cell=32):
+        self.cell = cell
+        self.bounds = []
+        self.cells = collections.defaultdict(list)
+        self.large = []
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def _cells(self, x, y, width, height):
+        cell = self.cell
+        return (
+            (cx, cy)
+            for cy in range(y // cell, (y + max(height, 1) - 1) // cell + 1)
+            for cx in range(x // cell, (x + max(width, 1) - 1) // cell + 1)
+        )
+
+    def insert(self, x, y, width, height):
+        key = len(self.bounds)
+        self.bounds.append((x, y, width, height))
+        columns = (x + max(width, 1) - 1) // self.cell - x // self.cell + 1
+        rows = (y + max(height, 1) - 1) // self.cell - y // self.cell + 1
+        if columns * rows > SpatialIndex.MAX_CELLS:
+            self.large.append(key)
+        else:
+            for cell in self._cells(x, y, width, height):
+                self.cells[cell].append(key)
+        return key
+
+    def query(self, x, y, width, height):
+        keys = set(self.large)
+        for cell in self._cells(x, y, width, height):
+            keys.update(self.cells.get(cell, ()))
+        return [
+            key
+            for key in sorted(keys)
+            if _intersects(self.bounds[key], (x, y, width, height))
+        ]
+
+
+def _intersects(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    return ax < bx + bw and bx < ax + aw and ay < by + bh and by < ay + ah
+
+
+def tiles(width, height, size):
+    # 把 width x height 的画布切成 size x size 的视口 (x, y, width, height)
+    for y in range(0, height, size):
+        for x in range(0, width, size):
+            yield (x, y, min(size, width - x), min(size, height - y))
+
 
 class DiagramFactory:
     @classmethod
-    def make_diagram(cls, width, height):
-        return cls.Diagram(width, height)
+    def make_diagram(cls, width, height, **kwargs):
+        return cls.Diagram(width, height, **kwargs)
 
     @classmethod
     def make_rectangle(cls, x, y, width, height, fill="white", stroke="black"):
@@ -28,16 +101,27 @@ class DiagramFactory:
             )
 
         def add(self, component):
-            for y, row in enumerate(component.rows):
-                for x, char in enumerate(row):
-                    self.diagram[y + component.y][x + component.x] = char
+            x = component.x
+            for y, row in enumerate(component.rows, component.y):
+                target = self.diagram[y]
+                if 0 <= x and x + len(row) <= len(target):
+                    # 完全落在画布内的行整段切片赋值
+                    target[x : x + len(row)] = row
+                else:
+                    for column, char in enumerate(row, x):
+                        target[column] = char
 
-        def save(self, filename_or_file):
+        def save(self, filename_or_file, viewport=None):
+            # 文本画布在 add 时已经栅格化, 视口只需截取对应的行和列
+            rows = self.diagram
+            if viewport is not None:
+                x, y, width, height = viewport
+                rows = (row[x : x + width] for row in rows[y : y + height])
             file = None if isinstance(filename_or_file, str) else filename_or_file
             try:
                 if file is None:
                     file = open(filename_or_file, "w", encoding="utf-8")
-                for row in self.diagram:
+                for row in rows:
                     print("".join(row), file=file)
             finally:
                 if isinstance(filename_or_file, str) and file is not None:
@@ -47,7 +131,8 @@ class DiagramFactory:
         def __init__(self, x, y, width, height, fill, stroke):
             self.x = x
             self.y = y
-            self.rows = DiagramFactory._create_rectangle(
+            # 相同尺寸和填充的矩形共享同一个只读的栅格
+            self.rows = DiagramFactory._rectangle_template(
                 width, height, DiagramFactory.BLANK if fill == "white" else "%"
             )
 
@@ -57,6 +142,15 @@ class DiagramFactory:
             self.y = y
             self.rows = [list(text)]
 
+    RECTANGLE_CACHE_SIZE = 1024
+
+    @staticmethod
+    @functools.lru_cache(maxsize=RECTANGLE_CACHE_SIZE)
+    def _rectangle_template(width, height, fill):
+        # 不可变的矩形栅格: 每行是一个 str, 整体是 tuple
+        rows = DiagramFactory._create_rectangle(width, height, fill)
+        return tuple("".join(row) for row in rows)
+
     @staticmethod
     def _create_rectangle(width, height, fill):
         rows = [[fill for _ in range(width)] for _ in range(height)]
@@ -71,6 +165,169 @@ class DiagramFactory:
         return rows
 
 
+class BufferDiagramFactory(DiagramFactory):
+
+    # 文本图表的连续缓冲区实现: 整个画布是一块 bytearray, 或者传入
+    # filename 时是内存映射的文件; 每行末尾带换行符, 组件逐行用切片赋值,
+    # 保存时一次写出。每个格子占一个字节, 非 ASCII 字符会被替换成 "?"
+
+    class Diagram:
+        def __init__(self, width, height, filename=None):
+            self.width = width
+            self.height = height
+            self.stride = width + 1
+            size = self.stride * height
+            self.file = None
+            if filename is None:
+                self.buffer = bytearray(size)
+            else:
+                self.file = open(filename, "w+b")
+                self.file.truncate(size)
+                self.buffer = mmap.mmap(self.file.fileno(), size)
+            blank = DiagramFactory.BLANK.encode() * width + b"\n"
+            for y in range(height):
+                self.buffer[y * self.stride : (y + 1) * self.stride] = blank
+            self.add(
+                BufferDiagramFactory.Rectangle(0, 0, width, height, "white", "black")
+            )
+
+        def add(self, component):
+            # 超出画布四边的部分被裁掉, 与 _rasterize_tile 一致
+            x, top, rows = component.x, component.y, component.rows
+            for y in range(max(top, 0), min(top + len(rows), self.height)):
+                row = rows[y - top]
+                start, stop = max(x, 0), min(x + len(row), self.width)
+                if start < stop:
+                    offset = y * self.stride
+                    self.buffer[offset + start : offset + stop] = row[start - x : stop - x]
+
+        def save(self, filename_or_file):
+            _write_bytes(filename_or_file, self.buffer)
+
+        def close(self):
+            if self.file is not None:
+                self.buffer.flush()
+                self.buffer.close()
+                self.file.close()
+                self.file = None
+
+    class Rectangle(DiagramFactory.Rectangle):
+        def __init__(self, x, y, width, height, fill, stroke):
+            self.x = x
+            self.y = y
+            self.rows = _encoded_rectangle(
+                width, height, DiagramFactory.BLANK if fill == "white" else "%"
+            )
+
+    class Text(DiagramFactory.Text):
+        def __init__(self, x, y, text, fontsize):
+            super().__init__(x, y, text, fontsize)
+            self.rows = [_encode(text)]
+
+
+def _encode(text):
+    return text.encode("ascii", "replace")
+
+
+@functools.lru_cache(maxsize=DiagramFactory.RECTANGLE_CACHE_SIZE)
+def _encoded_rectangle(width, height, fill):
+    rows = DiagramFactory._rectangle_template(width, height, fill)
+    return tuple(_encode(row) for row in rows)
+
+
+def _write_bytes(filename_or_file, buffer):
+    # 一次写出整个缓冲区; 文本流(如 sys.stdout)通过其底层的二进制 buffer
+    # 写出, 没有底层 buffer 的文本流(如 StringIO)才解码成 str
+    if isinstance(filename_or_file, str):
+        with open(filename_or_file, "wb") as file:
+            file.write(buffer)
+        return
+    file = getattr(filename_or_file, "buffer", None)
+    if file is not None:
+        filename_or_file.flush()
+        file.write(buffer)
+        return
+    try:
+        filename_or_file.write(buffer)
+    except TypeError:
+        filename_or_file.write(str(buffer, "ascii"))
+
+
+class TiledDiagramFactory(BufferDiagramFactory):
+
+    # add 时只登记组件, save 时把画布切成 tile x tile 的块, 在进程池中
+    # 并行栅格化到同一块共享内存, 最后直接把共享内存写出, 不再复制
+
+    class Diagram:
+        def __init__(self, width, height, tile=512):
+            self.width = width
+            self.height = height
+            self.tile = tile
+            self.components = []
+            self.index = SpatialIndex(cell=min(tile, 64))
+            self.add(
+                BufferDiagramFactory.Rectangle(0, 0, width, height, "white", "black")
+            )
+
+        def add(self, component):
+            rows = component.rows
+            width = max((len(row) for row in rows), default=0)
+            self.index.insert(component.x, component.y, width, len(rows))
+            self.components.append((component.x, component.y, rows))
+
+        def save(self, filename_or_file, processes=None):
+            size = (self.width + 1) * self.height
+            memory = shared_memory.SharedMemory(create=True, size=size)
+            try:
+                viewports = list(tiles(self.width, self.height, self.tile))
+                work = (
+                    [self.components[key] for key in self.index.query(*viewport)]
+                    for viewport in viewports
+                )
+                with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+                    for _ in executor.map(
+                        _rasterize_tile,
+                        itertools.repeat(memory.name),
+                        itertools.repeat(self.width),
+                        viewports,
+                        work,
+                    ):
+                        pass
+                buffer = memory.buf[:size]
+                try:
+                    _write_bytes(filename_or_file, buffer)
+                finally:
+                    buffer.release()
+            finally:
+                memory.close()
+                memory.unlink()
+
+
+def _rasterize_tile(name, width, viewport, components):
+    # 在工作进程中把与该块相交的组件按 z-order 画进共享内存中对应的区域
+    x0, y0, tile_width, tile_height = viewport
+    x1, y1 = x0 + tile_width, y0 + tile_height
+    stride = width + 1
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        buffer = memory.buf
+        blank = DiagramFactory.BLANK.encode() * tile_width
+        if x1 == width:
+            blank += b"\n"
+        for y in range(y0, y1):
+            buffer[y * stride + x0 : y * stride + x0 + len(blank)] = blank
+        for x, top, rows in components:
+            for y in range(max(top, y0), min(top + len(rows), y1)):
+                row = rows[y - top]
+                start, stop = max(x, x0), min(x + len(row), x1)
+                if start < stop:
+                    offset = y * stride
+                    buffer[offset + start : offset + stop] = row[start - x : stop - x]
+        del buffer
+    finally:
+        memory.close()
+
+
 class SvgDiagramFactory(DiagramFactory):
 
     # The make_* class methods are inherited
@@ -97,27 +354,50 @@ font-family="sans-serif" font-size="{fontsize}">{text}</text>"""
             pxwidth = width * SvgDiagramFactory.SVG_SCALE
             pxheight = height * SvgDiagramFactory.SVG_SCALE
             self.diagram = [SvgDiagramFactory.SVG_START.format(**locals())]
+            # 索引中的编号 i 对应 self.diagram[i + 1]
+            self.index = SpatialIndex()
             outline = SvgDiagramFactory.Rectangle(
                 0, 0, width, height, "lightgreen", "black"
             )
-            self.diagram.append(outline.svg)
+            self.add(outline)
 
         def add(self, component):
+            self.index.insert(*component.bounds)
             self.diagram.append(component.svg)
 
-        def save(self, filename_or_file):
+        def save(self, filename_or_file, viewport=None):
             file = None if isinstance(filename_or_file, str) else filename_or_file
             try:
                 if file is None:
                     file = open(filename_or_file, "w", encoding="utf-8")
-                file.write("\n".join(self.diagram))
+                if viewport is None:
+                    file.write("\n".join(self.diagram))
+                else:
+                    self._write_viewport(file, viewport)
                 file.write("\n" + SvgDiagramFactory.SVG_END)
             finally:
                 if isinstance(filename_or_file, str) and file is not None:
                     file.close()
 
+        def _write_viewport(self, file, viewport):
+            # 只输出与视口相交的组件, 整体平移使视口左上角位于原点
+            x, y, width, height = viewport
+            scale = SvgDiagramFactory.SVG_SCALE
+            file.write(
+                SvgDiagramFactory.SVG_START.format(
+                    pxwidth=width * scale, pxheight=height * scale
+                )
+            )
+            file.write(
+                '\n<g transform="translate({},{})">'.format(-x * scale, -y * scale)
+            )
+            for key in self.index.query(x, y, width, height):
+                file.write("\n" + self.diagram[key + 1])
+            file.write("\n</g>")
+
     class Rectangle:
         def __init__(self, x, y, width, height, fill, stroke):
+            self.bounds = (x, y, width, height)
             x *= SvgDiagramFactory.SVG_SCALE
             y *= SvgDiagramFactory.SVG_SCALE
             width *= SvgDiagramFactory.SVG_SCALE
@@ -126,16 +406,126 @@ font-family="sans-serif" font-size="{fontsize}">{text}</text>"""
 
     class Text:
         def __init__(self, x, y, text, fontsize):
+            # 文本基线在 y 处, 包围盒只是粗略估计
+            self.bounds = (x, y - 1, max(len(text), 1), 2)
             x *= SvgDiagramFactory.SVG_SCALE
             y *= SvgDiagramFactory.SVG_SCALE
             fontsize *= SvgDiagramFactory.SVG_SCALE // 10
             self.svg = SvgDiagramFactory.SVG_TEXT.format(**locals())
 
 
+class StreamingSvgDiagramFactory(SvgDiagramFactory):
+
+    # SVG 片段在 add 时就写入带缓冲的输出, 内存占用与组件数量无关;
+    # 文件名以 .svgz 结尾时用 gzip 压缩输出
+
+    BUFFER_SIZE = 1 << 16
+
+    class Diagram:
+        def __init__(self, width, height, filename_or_file):
+            self.target = filename_or_file
+            if not isinstance(filename_or_file, str):
+                self.file, self.owned = filename_or_file, False
+            elif filename_or_file.endswith(".svgz"):
+                self.file = gzip.open(filename_or_file, "wt", encoding="utf-8")
+                self.owned = True
+            else:
+                self.file = open(
+                    filename_or_file,
+                    "w",
+                    encoding="utf-8",
+                    buffering=StreamingSvgDiagramFactory.BUFFER_SIZE,
+                )
+                self.owned = True
+            pxwidth = width * SvgDiagramFactory.SVG_SCALE
+            pxheight = height * SvgDiagramFactory.SVG_SCALE
+            self.file.write(SvgDiagramFactory.SVG_START.format(**locals()))
+            outline = SvgDiagramFactory.Rectangle(
+                0, 0, width, height, "lightgreen", "black"
+            )
+            self.add(outline)
+
+        def add(self, component):
+            self.file.write("\n" + component.svg)
+
+        def save(self, filename_or_file=None):
+            # 输出目标在创建时已确定, save 只负责写结尾并关闭自己打开的文件;
+            # 传入的目标必须与创建时的相同
+            if filename_or_file is not None and not (
+                filename_or_file is self.target
+                or isinstance(filename_or_file, str)
+                and filename_or_file == self.target
+            ):
+                raise ValueError(
+                    "streaming diagram is written to {!r}, cannot save to {!r}".format(
+                        self.target, filename_or_file
+                    )
+                )
+            if self.file is None:
+                return
+            try:
+                self.file.write("\n" + SvgDiagramFactory.SVG_END)
+            finally:
+                if self.owned:
+                    self.file.close()
+                self.file = None
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            self.save()
+
+
+def benchmark(count=100000, shapes=((10, 4), (22, 5), (40, 8))):
+    """
+    比较每次新建栅格与共享模板两种方式, 大量重复矩形的吞吐量和内存
+    """
+
+    def fresh(x, y, width, height):
+        rectangle = DiagramFactory.Rectangle.__new__(DiagramFactory.Rectangle)
+        rectangle.x, rectangle.y = x, y
+        rectangle.rows = DiagramFactory._create_rectangle(width, height, "%")
+        return rectangle
+
+    def shared(x, y, width, height):
+        return DiagramFactory.make_rectangle(x, y, width, height, "yellow")
+
+    def build(make):
+        return [make(i % 50, i % 20, *shapes[i % len(shapes)]) for i in range(count)]
+
+    for name, make in (("fresh rows", fresh), ("shared template", shared)):
+        seconds = min(timeit.repeat(lambda: build(make), number=1, repeat=3))
+        tracemalloc.start()
+        rectangles = build(make)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del rectangles
+        print(
+            "{:<18}{:>12,.0f} rectangles/s{:>10.1f} MiB".format(
+                name, count / seconds, memory / 2 ** 20
+            )
+        )
+    diagram = DiagramFactory.make_diagram(100, 40)
+    rectangles = build(shared)
+    seconds = min(
+        timeit.repeat(
+            lambda: [diagram.add(rectangle) for rectangle in rectangles],
+            number=1,
+            repeat=3,
+        )
+    )
+    print("{:<18}{:>12,.0f} rectangles/s".format("Diagram.add", count / seconds))
+
+
 def main():
 
     import sys
 
+    if len(sys.argv) > 1 and sys.argv[1] == "-P":
+        benchmark()
+        return
+
     def create_diagram(factory):
         diagram = factory.make_diagram(30, 7)
         rectangle = factory.make_rectangle(4, 1, 22, 5, "yellow")
@@ -145,6 +535,8 @@ def main():
         return diagram
 
     # diagram = create_diagram(DiagramFactory)
+    # diagram = create_diagram(BufferDiagramFactory)
+    # diagram = create_diagram(TiledDiagramFactory)
     diagram = create_diagram(SvgDiagramFactory)
     diagram.save(sys.stdout)
 
@@ -1,15 +1,589 @@
 #!/usr/bin/env python3
 
 import atexit
+import collections
+import concurrent.futures
+import contextlib
+import itertools
+import mmap
 import os
 import shelve
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    import fcntl
+except ImportError:  # 非 POSIX 平台退化为无跨进程锁
+    fcntl = None
+
+
+class WriteBackCache:
+    """
+    放在 shelve 前面的回写式 LRU 缓存
+
+    读命中时不访问 dbm; 写入只标记为脏, 脏条目攒够 batch 个时批量写回,
+    被淘汰的脏条目在淘汰时写回, flush() 写回全部脏条目。
+    """
+
+    def __init__(self, store, size=1 << 18, batch=4096):
+        self.store = store
+        self.size = size
+        self.batch = batch
+        self.entries = collections.OrderedDict()
+        self.dirty = set()
+
+    def __getitem__(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            value = self.store[key]
+            self.entries[key] = value
+            self._evict()
+        else:
+            self.entries.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self.dirty.add(key)
+        if len(self.dirty) >= self.batch:
+            self._write_back()
+        self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.size:
+            key, value = self.entries.popitem(last=False)
+            if key in self.dirty:
+                self.dirty.discard(key)
+                self.store[key] = value
+
+    def _write_back(self):
+        for key in self.dirty:
+            self.store[key] = self.entries[key]
+        self.dirty.clear()
+
+    def flush(self):
+        self._write_back()
+        self.store.sync()
+
+    def close(self):
+        self.flush()
+        self.store.close()
+
+
+FIELDS = ("x", "y", "z", "color")
+DEFAULTS = (0, 0, 0, None)
+
+
+def _row(values):
+    # 补齐省略的字段
+    values = tuple(values)
+    return values + DEFAULTS[len(values) :]
+
+
+class ColorTable:
+    """
+    颜色的字典编码(intern 表): 每种颜色对应一个小整数编码, 0 表示 None
+
+    数据里通常只有几种颜色, 每个点只保存编码; 新颜色通过 save 回调
+    持久化, 由所属的 store 决定保存在哪里。stats() 给出表的大小和
+    编码时的命中率。
+    """
+
+    # 编码按 uint16 保存
+    MAX_CODE = 0xFFFF
+
+    def __init__(self, save=None):
+        self.save = save
+        self.hits = 0
+        self.misses = 0
+        self.load(())
+
+    def __len__(self):
+        return len(self._table[0]) - 1
+
+    @property
+    def colors(self):
+        return self._table[0]
+
+    @property
+    def codes(self):
+        return self._table[1]
+
+    def load(self, colors):
+        # 替换为持久化的内容(可能包含其他进程新增的颜色), 统计保留;
+        # 新表在局部建好后一次替换, 并发的 decode 不会看到建了一半的表
+        table = [None]
+        table.extend(colors)
+        self._table = (table, {color: code for code, color in enumerate(table)})
+
+    def encode(self, color):
+        colors, codes = self._table
+        code = codes.get(color)
+        if code is not None:
+            self.hits += 1
+            return code
+        self.misses += 1
+        code = len(colors)
+        if code > ColorTable.MAX_CODE:
+            raise ValueError("too many distinct colors")
+        if self.save is not None:
+            self.save(color)
+        colors.append(color)
+        codes[color] = code
+        return code
+
+    def decode(self, code):
+        return self._table[0][code]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(
+            size=len(self),
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hits / lookups if lookups else 0.0,
+        )
+
+
+class ShelveStore:
+    """
+    用 shelve 保存点的字段, key 为 "编号:字段名", 前面有一层 WriteBackCache
+
+    第一次使用时才打开, 导入模块不会创建文件; shelve 不支持多个进程
+    同时写入, 多进程共享请使用 ColumnStore。color 保存为 ColorTable
+    中的编码, 颜色表保存在 "colors" 中。
+    """
+
+    def __init__(self, filename="point.db"):
+        self.filename = filename
+        self._dbm = None
+        self.colors = ColorTable(self._save_color)
+
+    @property
+    def dbm(self):
+        if self._dbm is None:
+            self._dbm = WriteBackCache(shelve.open(self.filename))
+            atexit.register(self.close)
+            try:
+                self.colors.load(self._dbm["colors"])
+            except KeyError:
+                pass
+        return self._dbm
+
+    def _save_color(self, color):
+        dbm = self.dbm
+        dbm["colors"] = self.colors.colors[1:] + [color]
+
+    def _encode(self, name, value):
+        if name != "color":
+            return value
+        # 编码前先打开 dbm, 保证颜色表已经从文件加载
+        self.dbm
+        return self.colors.encode(value)
+
+    def __len__(self):
+        try:
+            return self.dbm["count"]
+        except KeyError:
+            return 0
+
+    def append(self, values):
+        index = len(self)
+        self.dbm["count"] = index + 1
+        for name, value in zip(FIELDS, values):
+            self.dbm["{:X}:{}".format(index, name)] = self._encode(name, value)
+        return index
+
+    def extend(self, rows):
+        # 绕过缓存直接写入 shelve, 计数只写一次, 最后只 sync 一次
+        start = index = len(self)
+        for values in rows:
+            for name, value in zip(FIELDS, _row(values)):
+                self.dbm.store["{:X}:{}".format(index, name)] = self._encode(
+                    name, value
+                )
+            index += 1
+        self.dbm["count"] = index
+        self.flush()
+        return range(start, index)
+
+    def load(self, indexes):
+        # 把这些点的字段预读进缓存
+        for index in indexes:
+            for name in FIELDS:
+                self.dbm["{:X}:{}".format(index, name)]
+
+    def find(self, color):
+        # 只比较编码; 先取 dbm, 保证颜色表已经加载
+        dbm = self.dbm
+        code = self.colors.codes.get(color)
+        if code is None:
+            return []
+        return [
+            index
+            for index in range(len(self))
+            if dbm["{:X}:color".format(index)] == code
+        ]
+
+    def get(self, index, name):
+        try:
+            value = self.dbm["{:X}:{}".format(index, name)]
+        except KeyError:
+            raise AttributeError(name) from None
+        return self.colors.decode(value) if name == "color" else value
+
+    def set(self, index, name, value):
+        if name not in FIELDS:
+            raise AttributeError(name)
+        self.dbm["{:X}:{}".format(index, name)] = self._encode(name, value)
+
+    def flush(self):
+        if self._dbm is not None:
+            self._dbm.flush()
+
+    def close(self):
+        if self._dbm is not None:
+            self._dbm.close()
+            self._dbm = None
+
+
+class ColumnStore:
+    """
+    列式的内存映射存储: x, y, z 各是一个 double 数组, color 是 ColorTable
+    中的 uint16 编码, 每列一个文件; 颜色表按行保存在 colors 文件中
+
+    按编号 O(1) 读写, 不需要 pickle, 磁盘占用是 容量 x 每点字节数;
+    第一次使用时才打开文件, 容量不够时按倍数扩展。
+
+    可以由多个进程同时打开: 写入在 writing() 的排他文件锁内进行,
+    同一时刻只有一个写者; 计数在字段写完后才更新, 所以读者不加锁也
+    只会看到完整的点, 需要在多个字段间保持一致时使用 reading()。
+    flock 的锁属于整个进程, 进程内的线程之间另用一个线程锁互斥。
+    文件只增不减, 其他进程扩容后, 读者按最新计数重新映射。
+    """
+
+    COLUMNS = (("x", "d"), ("y", "d"), ("z", "d"), ("color", "H"))
+
+    def __init__(self, path="point.columns", capacity=1024):
+        self.path = path
+        self.capacity = capacity
+        self.colors = ColorTable(self._save_color)
+        self._meta = None
+        self._lock = None
+        self._mutex = threading.RLock()
+        self._local = threading.local()
+        self._registered = False
+
+    def _map(self, name, size):
+        fd = os.open(os.path.join(self.path, name), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            return mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def _open(self):
+        with self._mutex:
+            if self._meta is not None:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            self._lock = os.open(
+                os.path.join(self.path, "lock"), os.O_RDWR | os.O_CREAT, 0o666
+            )
+            meta = self._map("meta", 8)
+            self._remap(max(self.capacity, struct.unpack_from("<Q", meta)[0]))
+            self._load_colors()
+            # 映射就绪后才设置 _meta, 其他线程据此判断是否已经打开
+            self._meta = meta
+            if not self._registered:
+                self._registered = True
+                atexit.register(self.close)
+                # flock 的锁跟随打开的文件, fork 出的子进程必须自己重新打开
+                if hasattr(os, "register_at_fork"):
+                    os.register_at_fork(after_in_child=self._forget)
+
+    def _load_colors(self):
+        # 与编码互斥: 否则在保存新颜色和追加进表之间重新加载会重复追加
+        with self._mutex:
+            try:
+                with open(os.path.join(self.path, "colors"), encoding="utf-8") as f:
+                    self.colors.load(f.read().splitlines())
+            except FileNotFoundError:
+                pass
+
+    def _save_color(self, color):
+        # 调用时已持有写锁
+        if not isinstance(color, str) or "\n" in color:
+            raise ValueError("color must be a single-line string")
+        with open(os.path.join(self.path, "colors"), "a", encoding="utf-8") as f:
+            f.write(color + "\n")
+
+    def _forget(self):
+        if self._meta is not None:
+            # fork 时其他线程可能正持有锁, 子进程里重新创建
+            self._mutex = threading.RLock()
+            self._local = threading.local()
+            self.close()
+
+    def _remap(self, capacity):
+        # 先建好新映射再替换; 其他线程手里的旧映射仍然有效, 不再引用时自动释放
+        mmaps = {
+            name: self._map(name, capacity * struct.calcsize(typecode))
+            for name, typecode in ColumnStore.COLUMNS
+        }
+        self._mmaps = mmaps
+        self._columns = {
+            name: memoryview(mmaps[name]).cast(typecode)
+            for name, typecode in ColumnStore.COLUMNS
+        }
+        self.capacity = capacity
+
+    def _resize(self, capacity):
+        with self._mutex:
+            if capacity > self.capacity:
+                self._remap(capacity)
+
+    def _reserve(self, count):
+        if self._meta is None:
+            self._open()
+        if count > self.capacity:
+            self._resize(max(count, self.capacity * 2))
+
+    def _check(self, index):
+        # 每次都重新读取计数: 其他进程可能已经追加了点;
+        # 编号超出本进程的映射时, 按最新计数重新映射
+        if self._meta is None:
+            self._open()
+        count = len(self)
+        if not 0 <= index < count:
+            raise IndexError("point index out of range")
+        if index >= self.capacity:
+            self._resize(count)
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        if self._meta is None:
+            self._open()
+        held = getattr(self._local, "held", None)
+        if held is not None:
+            # 本线程已持有锁时直接重入, 但读锁不能升级为写锁
+            if operation == "write" and held != operation:
+                raise RuntimeError("cannot write while holding a read lock")
+            yield self
+            return
+        with self._mutex:
+            if fcntl is not None:
+                fcntl.flock(
+                    self._lock, fcntl.LOCK_SH if operation == "read" else fcntl.LOCK_EX
+                )
+            self._local.held = operation
+            try:
+                yield self
+            finally:
+                self._local.held = None
+                if fcntl is not None:
+                    fcntl.flock(self._lock, fcntl.LOCK_UN)
+
+    def reading(self):
+        # 共享锁: 多个读者进程可以同时持有, 期间没有写者
+        return self._locked("read")
+
+    def writing(self):
+        # 排他锁: 同一时刻只有一个写者
+        return self._locked("write")
+
+    def __len__(self):
+        if self._meta is None:
+            if not os.path.exists(os.path.join(self.path, "meta")):
+                return 0
+            self._open()
+        return struct.unpack_from("<Q", self._meta)[0]
+
+    def append(self, values):
+        with self.writing():
+            index = len(self)
+            self._reserve(index + 1)
+            for name, value in zip(FIELDS, values):
+                self._set(index, name, value)
+            struct.pack_into("<Q", self._meta, 0, index + 1)
+        return index
+
+    def extend(self, rows):
+        # 全部字段写完后才更新计数, 其他读者看不到写了一半的点
+        with self.writing():
+            start = index = len(self)
+            for values in rows:
+                self._reserve(index + 1)
+                for name, value in zip(FIELDS, _row(values)):
+                    self._set(index, name, value)
+                index += 1
+            struct.pack_into("<Q", self._meta, 0, index)
+        return range(start, index)
+
+    def load(self, indexes):
+        # 内存映射的列按需换页, 不需要预读; 只确认这些编号都已分配
+        if indexes:
+            self._check(min(indexes))
+            self._check(max(indexes))
+
+    def find(self, color):
+        # 按颜色筛选只扫描编码列, 不解码字符串
+        count = len(self)
+        if not count:
+            return []
+        self._check(count - 1)
+        if color not in self.colors.codes:
+            self._load_colors()
+        code = self.colors.codes.get(color)
+        if code is None:
+            return []
+        codes = self._columns["color"][:count]
+        return list(itertools.compress(range(count), map(code.__eq__, codes)))
+
+    def get(self, index, name):
+        self._check(index)
+        try:
+            value = self._columns[name][index]
+        except KeyError:
+            raise AttributeError(name) from None
+        if name != "color":
+            return value
+        if value >= len(self.colors.colors):
+            # 其他进程新增的颜色
+            self._load_colors()
+        return self.colors.decode(value)
+
+    def set(self, index, name, value):
+        with self.writing():
+            self._check(index)
+            self._set(index, name, value)
+
+    def _set(self, index, name, value):
+        # 调用时已持有写锁(包括 _mutex), 颜色的加载和编码不会与其他线程交错
+        if name == "color":
+            if value not in self.colors.codes:
+                # 先合并其他进程新增的颜色, 避免分配出重复的编码
+                self._load_colors()
+            value = self.colors.encode(value)
+        try:
+            self._columns[name][index] = value
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def flush(self):
+        if self._meta is not None:
+            self._meta.flush()
+            for column in self._mmaps.values():
+                column.flush()
+
+    def close(self):
+        if self._meta is not None:
+            self.flush()
+            for column in self._columns.values():
+                column.release()
+            for column in self._mmaps.values():
+                column.close()
+            self._meta.close()
+            self._meta = None
+            os.close(self._lock)
+            self._lock = None
 
 
 class Point:
+    """
+    享元点: 对象本身只保存一个稳定的整数编号, 字段都在 store 中,
+    不会因为 id(self) 被复用而串数据
+    """
+
+    __slots__ = ("_Point__index",)
+    store = ColumnStore()
+
+    def __init__(self, x=0, y=0, z=0, color=None):
+        object.__setattr__(self, "_Point__index", self.store.append((x, y, z, color)))
+
+    @classmethod
+    def at(cls, index):
+        # 已存在的点的句柄, 不分配新编号
+        point = cls.__new__(cls)
+        object.__setattr__(point, "_Point__index", index)
+        return point
+
+    @classmethod
+    def bulk_create(cls, rows):
+        """
+        在一次事务中创建多个点, rows 是 (x, y, z, color) 元组的可迭代对象,
+        返回新点的编号 range
+        """
+        return cls.store.extend(rows)
+
+    @classmethod
+    def bulk_load(cls, indexes):
+        # 一次性取出一批已存在的点; 编号会被遍历多次, 生成器先转成列表
+        if not isinstance(indexes, range):
+            indexes = list(indexes)
+        cls.store.load(indexes)
+        return [cls.at(index) for index in indexes]
+
+    @classmethod
+    def with_color(cls, color):
+        return cls.bulk_load(cls.store.find(color))
+
+    @property
+    def index(self):
+        return self.__index
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self.store.get(self.__index, name)
+
+    def __setattr__(self, name, value):
+        self.store.set(self.__index, name, value)
+
+    def __repr__(self):
+        return "Point({0.x!r}, {0.y!r}, {0.z!r}, {0.color!r})".format(self)
+
+    @classmethod
+    def flush(cls):
+        cls.store.flush()
+
+
+class ShelvePoint(Point):
+
+    # 原来基于 shelve 的存储, 保留下来作对比
 
     __slots__ = ()
-    __dbm = shelve.open(os.path.join("point.db"))
+    store = ShelveStore("point.db")
+
+
+def _ingest(path, rows):
+    # 进程池中的写者, 同一个进程内复用已打开的 store
+    if Point.store.path != path:
+        Point.store = ColumnStore(path)
+    return Point.bulk_create(rows)
+
+
+def ingest(batches, workers=None):
+    """
+    用进程池把多批点写入 Point.store, 每批是一个写事务,
+    返回每批新点的编号 range
+    """
+    path = Point.store.path
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(_ingest, itertools.repeat(path), batches))
+
+
+class PlainPoint:
+
+    # 对比用: 普通对象, 字段在 __dict__ 中
 
     def __init__(self, x=0, y=0, z=0, color=None):
         self.x = x
@@ -17,39 +591,107 @@ class Point:
         self.z = z
         self.color = color
 
-    def __key(self, name):
-        return "{:X}:{}".format(id(self), name)
 
-    def __getattr__(self, name):
-        return Point.__dbm[self.__key(name)]
+class SlotsPoint:
 
-    def __setattr__(self, name, value):
-        Point.__dbm[self.__key(name)] = value
+    # 对比用: 使用 __slots__ 的对象
 
-    def __repr__(self):
-        return "Point({0.x!r}, {0.y!r}, {0.z!r}, {0.color!r})".format(self)
+    __slots__ = FIELDS
+
+    def __init__(self, x=0, y=0, z=0, color=None):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.color = color
+
+
+def _create(kind, size, path):
+    # path 是本次测量专用的文件名前缀
+    rows = ((i, i ** 2, i // 2) for i in range(size))
+    if kind == "plain":
+        return [PlainPoint(*row) for row in rows]
+    if kind == "slots":
+        return [SlotsPoint(*row) for row in rows]
+    if kind == "shelve":
+        ShelvePoint.store = ShelveStore(path + ".db")
+        return ShelvePoint.bulk_load(ShelvePoint.bulk_create(rows))
+    Point.store = ColumnStore(path + ".columns")
+    return Point.bulk_load(Point.bulk_create(rows))
 
-    atexit.register(__dbm.close)
+
+def _close():
+    Point.store.close()
+    ShelvePoint.store.close()
+
+
+def measure(kind, size):
+    """
+    在当前(全新的)进程中测一种实现: 第一遍计时, 第二遍用 tracemalloc
+    统计 Python 分配的峰值; 峰值 RSS 取两遍中的最大值
+    """
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        points = _create(kind, size, os.path.join(path, "timed"))
+        elapsed = time.perf_counter() - start
+        assert points[size - 1].x == size - 1
+        del points
+        _close()
+        tracemalloc.start()
+        points = _create(kind, size, os.path.join(path, "traced"))
+        traced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del points
+        _close()
+    try:
+        import resource
+    except ImportError:  # 非 POSIX 平台没有 getrusage, 不报告峰值 RSS
+        rss = 0
+    else:
+        # Linux 上 ru_maxrss 的单位是 KiB
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(size / elapsed, rss, traced)
+
+
+def benchmark(sizes):
+    # 每种实现在单独的子进程中测量, 峰值 RSS 互不干扰
+    print(
+        "{:<8}{:>12}{:>16}{:>14}{:>14}".format(
+            "kind", "points", "points/s", "peak RSS", "traced peak"
+        )
+    )
+    for size in sizes:
+        for kind in ("plain", "slots", "shelve", "columns"):
+            output = subprocess.run(
+                [sys.executable, __file__, "--measure", kind, str(size)],
+                stdout=subprocess.PIPE,
+                check=True,
+                universal_newlines=True,
+            ).stdout
+            rate, rss, traced = map(float, output.split())
+            print(
+                "{:<8}{:>12,}{:>16,.0f}{:>11.1f} MB{:>11.1f} MB".format(
+                    kind, size, rate, rss / 1e6, traced / 1e6
+                )
+            )
 
 
 def main():
-    regression = False
+    if len(sys.argv) > 3 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], int(sys.argv[3]))
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "-P":
+        # 非交互的基准测试: demo.py -P 1000 100000 ...
+        benchmark([int(size) for size in sys.argv[2:]] or [100000])
+        return
     size = 100
-    if len(sys.argv) > 2 and sys.argv[1] == "-P":
-        regression = True
-        size = int(sys.argv[2])
-    if len(sys.argv) > 1 and sys.argv[1] != "-P":
+    if len(sys.argv) > 1:
         size = int(sys.argv[1])
     points = []
     for i in range(size):
         points.append(Point(i, i ** 2, i // 2))
     assert points[size - 1].x == size - 1
-    if not regression:
-        print("create {:,} points".format(size))
-        input("wait until we can see how much memory is used")
-    else:
-        print(points)
-        input("wait until we can see how much memory is used")
+    print("create {:,} points".format(size))
+    input("wait until we can see how much memory is used")
 
 
 if __name__ == "__main__":